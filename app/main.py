@@ -1,5 +1,7 @@
 import os
+import io
 import json
+import hmac
 import base64
 import discord
 import gspread
@@ -10,11 +12,16 @@ import re
 import csv
 import random
 import time
+import itertools
 import pytz
+import requests
 from oauth2client.service_account import ServiceAccountCredentials
-from flask import Flask, jsonify
+from google.auth.exceptions import RefreshError, TransportError
+from google.auth.transport.requests import Request as GoogleAuthRequest
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, jsonify, request
 from datetime import datetime, timezone, timedelta
-from threading import Thread
+from threading import Thread, Event, Condition, Lock
 
 # ======================== Configurar Logging ======================== #
 logging.basicConfig(
@@ -45,7 +52,8 @@ def health():
         "sheets_status": {
             "client_exists": client is not None,
             "sheet_name": SHEET_NAME,
-            "sheet_title": sheet.title if sheet else None
+            "sheet_title": sheet.title if sheet else None,
+            "circuit_breaker": "aberto" if sheets_breaker.aberto else "fechado"
         },
         "timestamp": datetime.now().isoformat(),
         "environment": {
@@ -58,16 +66,57 @@ def health():
     else:
         return jsonify(status), 503  # Service Unavailable
 
+@app.route('/relatorio')
+def relatorio():
+    """Exporta o relatório semanal em CSV (requer o header Authorization: Bearer RELATORIO_TOKEN)"""
+    autorizacao = request.headers.get("Authorization", "")
+    token = autorizacao[len("Bearer "):] if autorizacao.startswith("Bearer ") else ""
+    if not RELATORIO_TOKEN or not hmac.compare_digest(token.encode(), RELATORIO_TOKEN.encode()):
+        return jsonify({"error": "Não autorizado"}), 403
+
+    if sheet is None:
+        return jsonify({"error": "Sem conexão com o Google Sheets"}), 503
+
+    try:
+        membros = buscar_dados_relatorio()
+    except SheetsIndisponivel:
+        return jsonify({"error": "Google Sheets indisponível"}), 503
+    except Exception as e:
+        logger.error(f"❌ Erro ao gerar relatório: {str(e)}")
+        return jsonify({"error": "Erro ao ler a planilha"}), 502
+
+    return Response(
+        gerar_relatorio_csv(membros),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f"attachment; filename={nome_arquivo_relatorio()}"}
+    )
+
 # ======================== CONFIGURAÇÕES ======================== #
 
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 GOOGLE_CREDENTIALS = os.getenv("GOOGLE_CREDENTIALS")
 SHEET_NAME = os.getenv("SHEET_NAME")  # Nome da planilha do Google Sheets
+SHEET_KEY = os.getenv("SHEET_KEY")  # ID da planilha (opcional, evita a busca pelo nome no Drive)
 PAINEL_CONTROLE = os.getenv("PAINEL_CONTROLE", "PAINEL DE CONTROLE")  # Nome da aba do painel de controle
+RELATORIO_TOKEN = os.getenv("RELATORIO_TOKEN")  # Token do endpoint /relatorio (desativado se vazio)
 
 # Define o diretório de dados com base no ambiente
 DATA_DIR = os.getenv("DATA_DIR", "/app/data")
 
+# Prazo (em segundos) para concluir o encerramento após SIGTERM/SIGINT.
+# O Cloud Run aguarda 10s antes de enviar SIGKILL.
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "8"))
+SHUTDOWN_CLOSE_RESERVE = 2  # Parte do prazo reservada para fechar a conexão com o Discord
+
+# Circuit breaker do Google Sheets: falhas seguidas para abrir e espera (em segundos) até testar a recuperação
+SHEETS_BREAKER_FALHAS = int(os.getenv("SHEETS_BREAKER_FALHAS", "5"))
+SHEETS_BREAKER_ESPERA = float(os.getenv("SHEETS_BREAKER_ESPERA", "60"))
+
+SHEETS_SCOPES = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+SHEETS_TIMEOUT = (10, 30)  # Timeout de conexão e leitura das requisições ao Google Sheets
+SHEETS_POOL_SIZE = 10  # Conexões keep-alive mantidas com a API do Google
+TOKEN_REFRESH_MARGIN = 300  # Renova o token de acesso 5 minutos antes de expirar
+
 # Garante que o diretório existe
 os.makedirs(DATA_DIR, exist_ok=True)
 
@@ -77,33 +126,203 @@ creds_json = json.loads(base64.b64decode(GOOGLE_CREDENTIALS))
 # Variáveis globais
 client = None
 sheet = None
+sheet_key = None  # ID da planilha aberta, reaproveitado nas reconexões
+abas_cache = {}  # Abas já carregadas, por nome
+discord_loop = None  # Loop asyncio onde o cliente Discord está rodando
+encerrando = Event()  # Sinaliza que o bot não deve aceitar novas operações
 
 # ======================== FUNÇÕES DE CONEXÃO COM GOOGLE SHEETS ======================== #
 
+class SheetsIndisponivel(Exception):
+    """O circuit breaker está aberto e a chamada ao Google Sheets não foi feita"""
+
+class CircuitBreaker:
+    """Interrompe as chamadas ao Google Sheets após falhas seguidas e testa a recuperação com uma única requisição"""
+
+    CHAMADA_NORMAL = 0  # Ticket das chamadas feitas com o circuito fechado
+
+    def __init__(self, limite_falhas, espera):
+        self.limite_falhas = limite_falhas
+        self.espera = espera
+        self.falhas = 0
+        self.aberto_desde = None  # time.monotonic() da abertura, None se fechado
+        self.sonda = None  # Ticket da sonda em andamento
+        self._proxima_sonda = itertools.count(1)
+        self._lock = Lock()
+
+    @property
+    def aberto(self):
+        return self.aberto_desde is not None
+
+    def _espera_concluida(self):
+        return self.sonda is None and time.monotonic() - self.aberto_desde >= self.espera
+
+    def disponivel(self):
+        """Indica se uma chamada seria permitida agora, sem reservar a sonda"""
+        with self._lock:
+            return self.aberto_desde is None or self._espera_concluida()
+
+    def permitir(self):
+        """Retorna o ticket da chamada, ou None se ela não pode ser feita.
+
+        Com o circuito aberto, libera apenas uma sonda após a espera; só o resultado
+        dessa sonda (identificada pelo ticket) fecha ou reabre o circuito.
+        """
+        with self._lock:
+            if self.aberto_desde is None:
+                return self.CHAMADA_NORMAL
+            if not self._espera_concluida():
+                return None
+            self.sonda = next(self._proxima_sonda)
+            logger.info("🔌 Circuit breaker: testando a recuperação do Google Sheets...")
+            return self.sonda
+
+    def registrar_sucesso(self, ticket):
+        with self._lock:
+            if self.aberto_desde is None:
+                self.falhas = 0
+            elif ticket == self.sonda:
+                logger.info("✅ Circuit breaker fechado: Google Sheets respondendo novamente")
+                self.falhas = 0
+                self.aberto_desde = None
+                self.sonda = None
+
+    def registrar_falha(self, ticket):
+        with self._lock:
+            if self.aberto_desde is None:
+                self.falhas += 1
+                if self.falhas >= self.limite_falhas:
+                    logger.warning(f"⛔ Circuit breaker aberto após {self.falhas} falhas. Operações irão para o arquivo de pendências por {self.espera:.0f}s")
+                    self.aberto_desde = time.monotonic()
+            elif ticket == self.sonda:
+                logger.warning(f"⛔ Circuit breaker reaberto: sonda falhou. Nova tentativa em {self.espera:.0f}s")
+                self.aberto_desde = time.monotonic()
+                self.sonda = None
+
+    def cancelar_sonda(self, ticket):
+        """Libera a sonda quando a chamada falhou por um motivo que não diz nada sobre a API"""
+        with self._lock:
+            if ticket == self.sonda:
+                self.sonda = None
+
+sheets_breaker = CircuitBreaker(SHEETS_BREAKER_FALHAS, SHEETS_BREAKER_ESPERA)
+
+def _indica_indisponibilidade(e):
+    """Erros de rede, 429 e 5xx (inclusive na renovação do token) indicam indisponibilidade; os demais significam que a API respondeu"""
+    if isinstance(e, (requests.exceptions.RequestException, TransportError)):
+        return True
+    if isinstance(e, RefreshError):
+        return getattr(e, "retryable", False)  # 5xx, 408 e 429 do endpoint de token
+    if isinstance(e, gspread.exceptions.APIError):
+        status = getattr(e.response, "status_code", 0)
+        return status == 429 or status >= 500
+    return False
+
+def chamar_sheets(func):
+    """Executa uma chamada ao Google Sheets passando pelo circuit breaker"""
+    ticket = sheets_breaker.permitir()
+    if ticket is None:
+        raise SheetsIndisponivel("Google Sheets indisponível (circuit breaker aberto)")
+    try:
+        resultado = func()
+    except Exception as e:
+        if _indica_indisponibilidade(e):
+            sheets_breaker.registrar_falha(ticket)
+        elif isinstance(e, gspread.exceptions.GSpreadException):
+            sheets_breaker.registrar_sucesso(ticket)
+        else:
+            sheets_breaker.cancelar_sonda(ticket)
+        raise
+    sheets_breaker.registrar_sucesso(ticket)
+    return resultado
+
 def update_with_exponential_backoff(func, max_retries=5):
     """Executa uma função com retry exponencial"""
     retries = 0
     while retries < max_retries:
         try:
-            return func()
+            return chamar_sheets(func)
         except (gspread.exceptions.APIError, gspread.exceptions.GSpreadException) as e:
             wait_time = (2 ** retries) + random.uniform(0, 1)
             retries += 1
-            if retries < max_retries:
+            if retries < max_retries and not encerrando.is_set() and not sheets_breaker.aberto:
                 logger.warning(f"⚠️ Tentativa {retries}/{max_retries} falhou. Esperando {wait_time:.2f}s antes de tentar novamente.")
                 time.sleep(wait_time)
             else:
                 raise e
 
+def _carregar_sheet_key():
+    """ID da planilha: variável SHEET_KEY ou o salvo em disco na última busca pelo nome"""
+    if SHEET_KEY:
+        return SHEET_KEY
+    try:
+        filepath = os.path.join(DATA_DIR, "sheet_key.json")
+        if os.path.exists(filepath):
+            with open(filepath, "r") as f:
+                dados = json.load(f)
+            if dados.get("sheet_name") == SHEET_NAME:
+                return dados.get("sheet_key")
+    except Exception as e:
+        logger.warning(f"⚠️ Erro ao ler ID da planilha salvo: {str(e)}")
+    return None
+
+def _salvar_sheet_key(key):
+    try:
+        with open(os.path.join(DATA_DIR, "sheet_key.json"), "w") as f:
+            json.dump({"sheet_name": SHEET_NAME, "sheet_key": key}, f)
+    except Exception as e:
+        logger.warning(f"⚠️ Erro ao salvar ID da planilha: {str(e)}")
+
+def _remover_sheet_key():
+    try:
+        filepath = os.path.join(DATA_DIR, "sheet_key.json")
+        if os.path.exists(filepath):
+            os.remove(filepath)
+    except Exception as e:
+        logger.warning(f"⚠️ Erro ao remover ID da planilha salvo: {str(e)}")
+
+def _criar_cliente():
+    """Cria o cliente autorizado com uma sessão HTTP keep-alive reaproveitada por todas as chamadas"""
+    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_json, SHEETS_SCOPES)
+    novo_cliente = gspread.authorize(creds)
+    novo_cliente.session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=SHEETS_POOL_SIZE))
+    novo_cliente.set_timeout(SHEETS_TIMEOUT)
+    return novo_cliente
+
+def _abrir_planilha():
+    """Abre a planilha pelo ID, reaproveitando o cliente autorizado já existente"""
+    global client, sheet, sheet_key
+    if client is None:
+        client = _criar_cliente()
+
+    sheet_key = sheet_key or _carregar_sheet_key()
+    nova_sheet = None
+    if sheet_key:
+        try:
+            nova_sheet = chamar_sheets(lambda: client.open_by_key(sheet_key))
+        except (gspread.exceptions.SpreadsheetNotFound, gspread.exceptions.APIError) as e:
+            # gspread 5.x responde a um ID inexistente com APIError 404
+            nao_encontrada = not isinstance(e, gspread.exceptions.APIError) or getattr(e.response, "status_code", 0) == 404
+            if SHEET_KEY or not nao_encontrada:
+                raise
+            # Planilha recriada com o mesmo nome: descarta o ID salvo e busca pelo nome
+            logger.warning("⚠️ ID da planilha salvo não encontrado. Buscando novamente pelo nome...")
+            _remover_sheet_key()
+            sheet_key = None
+
+    if nova_sheet is None:
+        # Busca pelo nome no Drive apenas uma vez; depois o ID fica salvo
+        nova_sheet = chamar_sheets(lambda: client.open(SHEET_NAME))
+        sheet_key = nova_sheet.id
+        _salvar_sheet_key(sheet_key)
+
+    sheet = nova_sheet
+    abas_cache.clear()
+    return sheet
+
 def connect_to_sheets():
-    global client, sheet
     try:
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(
-            creds_json,
-            ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-        )
-        client = gspread.authorize(creds)
-        sheet = client.open(SHEET_NAME)
+        _abrir_planilha()
         logger.info("✅ Conectado à planilha: %s", sheet.title)
         return sheet
     except Exception as e:
@@ -111,21 +330,47 @@ def connect_to_sheets():
         raise
 
 def reconnect_sheets():
-    global client, sheet
     try:
         logger.info("🔄 Reconectando ao Google Sheets...")
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(
-            creds_json,
-            ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-        )
-        client = gspread.authorize(creds)
-        sheet = client.open(SHEET_NAME)
+        _abrir_planilha()
         logger.info("✅ Reconectado à planilha: %s", sheet.title)
         return sheet
     except Exception as e:
         logger.error("❌ Erro ao reconectar com Google Sheets: %s", str(e))
         return None
 
+def obter_aba(aba_nome):
+    """Retorna a aba pelo nome, reaproveitando o objeto já carregado"""
+    aba = abas_cache.get(aba_nome)
+    if aba is None:
+        aba = chamar_sheets(lambda: sheet.worksheet(aba_nome))
+        abas_cache[aba_nome] = aba
+    return aba
+
+def descartar_aba(aba_nome, e):
+    """Remove a aba do cache quando a API rejeita a chamada (aba renomeada ou recriada)"""
+    if isinstance(e, gspread.exceptions.APIError) and not _indica_indisponibilidade(e):
+        if abas_cache.pop(aba_nome, None) is not None:
+            logger.warning(f"⚠️ Aba {aba_nome} descartada do cache após erro da API")
+
+def renovar_token_periodicamente():
+    """Renova o token de acesso do Google em segundo plano antes de expirar"""
+    auth_request = GoogleAuthRequest()
+    while not encerrando.is_set():
+        espera = 60
+        try:
+            if client is not None:
+                credenciais = client.auth
+                restante = (credenciais.expiry - datetime.utcnow()).total_seconds() if credenciais.expiry else 0
+                if restante <= TOKEN_REFRESH_MARGIN:
+                    credenciais.refresh(auth_request)
+                    restante = (credenciais.expiry - datetime.utcnow()).total_seconds()
+                    logger.info(f"🔑 Token do Google Sheets renovado (expira em {restante / 60:.0f} min)")
+                espera = max(restante - TOKEN_REFRESH_MARGIN, 60)
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao renovar token do Google Sheets: {str(e)}")
+        encerrando.wait(espera)
+
 # Primeira conexão ao iniciar
 # connect_to_sheets()
 
@@ -192,6 +437,100 @@ def save_pending_update(passaporte, quantidade, operacao="guardar"):
         logger.error(f"❌ Erro ao salvar backup: {str(e)}")
         return False
 
+# ======================== CONTROLE DE OPERAÇÕES EM ANDAMENTO ======================== #
+
+# Operações sendo gravadas na planilha, para que o encerramento possa aguardá-las ou salvá-las
+operacoes_em_andamento = {}
+operacoes_lock = Condition()
+_proximo_token = itertools.count()
+
+# Relatório do encerramento (só é preenchido depois que o encerramento começa)
+operacoes_gravadas = []
+operacoes_adiadas = []
+
+class OperacaoAdiada(Exception):
+    """A operação não foi escrita agora e está salva no arquivo de pendências (encerramento ou domingo)"""
+
+class OperacaoInvalida(Exception):
+    """A operação reprocessada nunca poderá ser escrita (passaporte ou quantidade inválidos)"""
+
+def _salvar_adiada(dados):
+    """Salva a operação no arquivo de pendências (chamada com operacoes_lock adquirido)"""
+    if not dados["pendente"]:  # Operações reprocessadas já estão no arquivo
+        save_pending_update(dados["passaporte"], dados["quantidade"], dados["operacao"])
+    if encerrando.is_set():
+        operacoes_adiadas.append(dados)
+
+def registrar_operacao(passaporte, quantidade, operacao, pendente=False):
+    """Registra uma operação em andamento e retorna seu token; durante o encerramento, salva e recusa a operação"""
+    with operacoes_lock:
+        dados = {
+            "passaporte": passaporte,
+            "quantidade": quantidade,
+            "operacao": operacao,
+            "pendente": pendente,  # Já está no arquivo de pendências
+            "escrevendo": False
+        }
+        if encerrando.is_set():
+            _salvar_adiada(dados)
+            raise OperacaoAdiada()
+        token = next(_proximo_token)
+        operacoes_em_andamento[token] = dados
+        return token
+
+def iniciar_escrita(token):
+    """Marca a operação como escrevendo na planilha, se o encerramento ainda não a adiou"""
+    with operacoes_lock:
+        dados = operacoes_em_andamento.get(token)
+        if dados is None:
+            raise OperacaoAdiada()
+        dados["escrevendo"] = True
+
+def concluir_operacao(token):
+    """Remove a operação das operações em andamento após ser gravada"""
+    with operacoes_lock:
+        dados = operacoes_em_andamento.pop(token, None)
+        if dados is not None and encerrando.is_set():
+            operacoes_gravadas.append(dados)
+        operacoes_lock.notify_all()
+
+def adiar_operacao(token):
+    """Salva a operação no arquivo de pendências, se o encerramento ainda não o fez"""
+    with operacoes_lock:
+        dados = operacoes_em_andamento.pop(token, None)
+        if dados is not None:
+            _salvar_adiada(dados)
+        operacoes_lock.notify_all()
+
+def _aguardar_operacoes(prazo, apenas_escrevendo=False):
+    """Aguarda as operações em andamento até o prazo (chamada com operacoes_lock adquirido)"""
+    while any(dados["escrevendo"] or not apenas_escrevendo for dados in operacoes_em_andamento.values()):
+        restante = prazo - time.monotonic()
+        if restante <= 0:
+            break
+        operacoes_lock.wait(restante)
+
+def drenar_operacoes(prazo_drenagem, prazo):
+    """Aguarda as operações em andamento e salva no arquivo de pendências as que não terminarem.
+
+    Operações que ainda não começaram a escrever são adiadas em prazo_drenagem. As que já
+    enviaram a escrita são aguardadas até o prazo final, para não serem reaplicadas em duplicidade.
+    """
+    with operacoes_lock:
+        _aguardar_operacoes(prazo_drenagem)
+
+        for token, dados in list(operacoes_em_andamento.items()):
+            if not dados["escrevendo"]:
+                del operacoes_em_andamento[token]
+                _salvar_adiada(dados)
+
+        _aguardar_operacoes(prazo, apenas_escrevendo=True)
+
+        for token in list(operacoes_em_andamento):
+            dados = operacoes_em_andamento.pop(token)
+            logger.warning(f"⚠️ Escrita ainda em andamento no fim do prazo: {dados['passaporte']}, {dados['quantidade']}, {dados['operacao']}. Pode ser aplicada em duplicidade.")
+            _salvar_adiada(dados)
+
 def process_pending_updates():
     try:
         filepath = os.path.join(DATA_DIR, "pending_updates.csv")
@@ -200,6 +539,7 @@ def process_pending_updates():
             
         pending = []
         processed_indices = []
+        houve_falha = False
         
         # Lê o arquivo para memória
         with open(filepath, "r") as f:
@@ -215,29 +555,48 @@ def process_pending_updates():
         
         if not pending:
             return
+
+        if not sheets_breaker.disponivel():
+            logger.info(f"⏸️ Circuit breaker aberto. {len(pending)} atualizações pendentes aguardando o Google Sheets")
+            return
+
+        if get_brazil_datetime().weekday() == 6:  # Domingo não registra farm
+            logger.info(f"⏸️ Domingo: {len(pending)} atualizações pendentes mantidas no arquivo até segunda-feira")
+            return
             
         logger.info(f"🔄 Processando {len(pending)} atualizações pendentes")
         
         for i, passaporte, quantidade, operacao, tentativas in pending:
+            if encerrando.is_set():  # Restante fica no arquivo para a próxima execução
+                break
+
             if tentativas >= 5:  # Limite máximo de tentativas
                 logger.warning(f"⚠️ Desistindo após 5 tentativas: {passaporte}, {quantidade}, {operacao}")
                 processed_indices.append(i)
                 continue
                 
             try:
-                update_sheet(passaporte, quantidade, operacao=operacao, notify=False)
+                # Com pendente=True, update_sheet levanta exceção se a escrita não aconteceu
+                update_sheet(passaporte, quantidade, operacao=operacao, notify=False, pendente=True)
                 processed_indices.append(i)
                 logger.info(f"✅ Processada atualização pendente: {passaporte}, {quantidade}, {operacao}")
+            except OperacaoAdiada:
+                logger.info(f"⏸️ Atualização pendente mantida no arquivo: {passaporte}, {quantidade}, {operacao}")
+                break
+            except OperacaoInvalida as e:
+                logger.warning(f"🗑️ Descartada atualização pendente inválida: {passaporte}, {quantidade}, {operacao} ({str(e)})")
+                processed_indices.append(i)
             except Exception as e:
                 logger.error(f"❌ Erro ao processar atualização pendente: {str(e)}")
                 
                 # Incrementa o contador de tentativas
                 idx = pending.index((i, passaporte, quantidade, operacao, tentativas))
                 pending[idx] = (i, passaporte, quantidade, operacao, tentativas + 1)
+                houve_falha = True
                 break
         
         # Atualiza o arquivo removendo itens processados e incrementando tentativas
-        if processed_indices:
+        if processed_indices or houve_falha:
             updated_rows = []
             with open(filepath, "r") as f:
                 reader = csv.reader(f)
@@ -256,9 +615,12 @@ def process_pending_updates():
                                 break
                         updated_rows.append(row)
             
-            with open(filepath, "w") as f:
+            # Grava em arquivo temporário e substitui, para não corromper o arquivo se o processo for encerrado
+            tmp_filepath = filepath + ".tmp"
+            with open(tmp_filepath, "w") as f:
                 writer = csv.writer(f)
                 writer.writerows(updated_rows)
+            os.replace(tmp_filepath, filepath)
                 
             logger.info(f"✅ Processadas {len(processed_indices)} de {len(pending)} atualizações pendentes")
     except Exception as e:
@@ -284,12 +646,22 @@ dias = {
     6: ("FARM DOM", 5)          # Domingo -> Coluna 5
 }
 
-def update_sheet(passaporte, quantidade, operacao="guardar", notify=True):
+def update_sheet(passaporte, quantidade, operacao="guardar", notify=True, pendente=False):
+    """Atualiza a planilha e retorna a mensagem para o usuário.
+
+    Com pendente=True (reprocessamento do arquivo de pendências), levanta exceção sempre que a
+    escrita não acontece: OperacaoInvalida para descartar a linha, OperacaoAdiada ou o erro
+    original para mantê-la no arquivo.
+    """
     # Validações
     if not str(passaporte).isdigit():
+        if pendente:
+            raise OperacaoInvalida("passaporte inválido")
         return "❌ Formato de passaporte inválido (deve conter apenas números)"
     
     if quantidade <= 0 or quantidade > 10000:  # limite razoável
+        if pendente:
+            raise OperacaoInvalida("quantidade inválida")
         return "❌ Quantidade inválida"
     
     # Use o horário de Brasília para determinar o dia
@@ -301,79 +673,98 @@ def update_sheet(passaporte, quantidade, operacao="guardar", notify=True):
     
     # Se for domingo (dia 6), não registra e retorna mensagem
     if hoje == 6:
+        if pendente:
+            raise OperacaoAdiada()
         return "⚠️ **Atenção:** Aos domingos não é contabilizado farm de Alumínio. Os valores serão zerados ao final do dia para a nova semana."
     
     aba_nome, coluna = dias[hoje]  # Define qual aba e qual coluna usar
     
+    # Registrar a operação para que o encerramento possa aguardá-la ou salvá-la
+    try:
+        token = registrar_operacao(passaporte, quantidade, operacao, pendente=pendente)
+    except OperacaoAdiada:
+        if pendente:
+            raise
+        logger.info(f"💾 Operação adiada pelo encerramento: {passaporte}, {quantidade}, {operacao}")
+        return f"⚠️ O bot está reiniciando. Seu registro ({passaporte}, {quantidade}x, {operacao}) foi salvo e será processado em breve."
+
     try:
-        # Tente acessar a planilha
-        aba = sheet.worksheet(aba_nome)
-    except (gspread.exceptions.APIError, gspread.exceptions.GSpreadException) as e:
-        logger.warning(f"⚠️ Erro de conexão com Google Sheets: {str(e)}. Reconectando...")
-        reconnect_sheets()
-        
-        # Tentar novamente após reconexão
         try:
-            aba = sheet.worksheet(aba_nome)
+            # Tente acessar a planilha (a reconexão fica a cargo das tarefas periódicas)
+            aba = obter_aba(aba_nome)
         except Exception as e:
-            logger.error(f"❌ Falha na reconexão: {str(e)}")
-            save_pending_update(passaporte, quantidade, operacao)
+            logger.error(f"❌ Erro ao acessar a aba {aba_nome}: {str(e)}")
+            adiar_operacao(token)
+            if pendente:
+                raise
             return f"⚠️ Problema temporário de conexão com a planilha. Seu registro ({passaporte}, {quantidade}x, {operacao}) foi salvo e será processado em breve."
 
-    try:
-        # Encapsular operações em função para retry
-        def update_operation():
-            # Buscar o passaporte na planilha
-            cell = aba.find(str(passaporte))
-
-            if cell:
-                row = cell.row
-                current_value = aba.cell(row, coluna).value
-                current_value = int(current_value if current_value else 0)
+        try:
+            # Encapsular operações em função para retry
+            def update_operation():
+                # Buscar o passaporte na planilha
+                cell = aba.find(str(passaporte))
+
+                if cell:
+                    row = cell.row
+                    current_value = aba.cell(row, coluna).value
+                    current_value = int(current_value if current_value else 0)
                 
-                # Verificar se é para guardar ou retirar
-                if operacao == "guardar":
-                    novo_valor = current_value + quantidade
-                    action_text = "adicionou"
-                else:  # retirar
-                    novo_valor = max(0, current_value - quantidade)  # Não permitir valor negativo
-                    action_text = "retirou"
+                    # Verificar se é para guardar ou retirar
+                    if operacao == "guardar":
+                        novo_valor = current_value + quantidade
+                        action_text = "adicionou"
+                    else:  # retirar
+                        novo_valor = max(0, current_value - quantidade)  # Não permitir valor negativo
+                        action_text = "retirou"
                 
-                # Atualização mais eficiente com cell_range
-                cell_range = f"{gspread.utils.rowcol_to_a1(row, coluna)}"
-                aba.update(cell_range, [[novo_valor]])
-                return novo_valor, False, action_text
-            else:
-                # Para novos registros, só permitimos guardar (não faz sentido retirar algo que não existe)
-                if operacao == "retirar":
-                    return 0, True, "tentou retirar"
+                    # Atualização mais eficiente com cell_range
+                    cell_range = f"{gspread.utils.rowcol_to_a1(row, coluna)}"
+                    iniciar_escrita(token)
+                    aba.update(cell_range, [[novo_valor]])
+                    return novo_valor, False, action_text
+                else:
+                    # Para novos registros, só permitimos guardar (não faz sentido retirar algo que não existe)
+                    if operacao == "retirar":
+                        return 0, True, "tentou retirar"
                     
-                novo_valor = quantidade
-                # Criar uma linha com espaços vazios até a coluna desejada
-                new_row = [passaporte] + [""] * (coluna - 2) + [novo_valor]
-                aba.append_row(new_row)
-                return novo_valor, True, "adicionou"
-
-        # Executar com retry
-        novo_valor, is_new, action_text = update_with_exponential_backoff(update_operation)
-
-        # Preparar mensagem de sucesso
-        if is_new and operacao == "retirar":
-            message = f"⚠️ **Passaporte {passaporte}** tentou retirar **{quantidade}x Alumínio**, mas não é da PASTELARIA DO CHINA."
-            logger.info(f"⚠️ Tentativa de retirada sem registro: {passaporte} tentou retirar {quantidade} Alumínio em {aba_nome}, coluna {coluna}")
-        else:
-            action = "criado novo registro" if is_new else "atualizado registro existente"
-            op_text = "registrou" if operacao == "guardar" else "retirou"
-            message = f"✅ **Passaporte {passaporte}** {op_text} **{quantidade}x Alumínio** em `{aba_nome}` no báu de Membros da PASTELARIA. {action.capitalize()} Meta Semanal: {novo_valor}."
-            if operacao == "guardar":
-                message += " Contribuição adicionada à sua meta semanal!"
-            logger.info(f"✅ {action}: {passaporte} {action_text} {quantidade} Alumínio em {aba_nome}, coluna {coluna}")
+                    novo_valor = quantidade
+                    # Criar uma linha com espaços vazios até a coluna desejada
+                    new_row = [passaporte] + [""] * (coluna - 2) + [novo_valor]
+                    iniciar_escrita(token)
+                    aba.append_row(new_row)
+                    return novo_valor, True, "adicionou"
+
+            # Executar com retry
+            novo_valor, is_new, action_text = update_with_exponential_backoff(update_operation)
+
+            # Preparar mensagem de sucesso
+            if is_new and operacao == "retirar":
+                message = f"⚠️ **Passaporte {passaporte}** tentou retirar **{quantidade}x Alumínio**, mas não é da PASTELARIA DO CHINA."
+                logger.info(f"⚠️ Tentativa de retirada sem registro: {passaporte} tentou retirar {quantidade} Alumínio em {aba_nome}, coluna {coluna}")
+            else:
+                action = "criado novo registro" if is_new else "atualizado registro existente"
+                op_text = "registrou" if operacao == "guardar" else "retirou"
+                message = f"✅ **Passaporte {passaporte}** {op_text} **{quantidade}x Alumínio** em `{aba_nome}` no báu de Membros da PASTELARIA. {action.capitalize()} Meta Semanal: {novo_valor}."
+                if operacao == "guardar":
+                    message += " Contribuição adicionada à sua meta semanal!"
+                logger.info(f"✅ {action}: {passaporte} {action_text} {quantidade} Alumínio em {aba_nome}, coluna {coluna}")
         
-        return message
-    except Exception as e:
-        logger.error(f"❌ Erro ao atualizar planilha: {str(e)}")
-        save_pending_update(passaporte, quantidade, operacao)
-        return f"⚠️ Problema ao atualizar a planilha. Seu registro ({passaporte}, {quantidade}x, {operacao}) foi salvo e será processado em breve."
+            return message
+        except OperacaoAdiada:
+            if pendente:
+                raise
+            logger.info(f"💾 Operação adiada pelo encerramento: {passaporte}, {quantidade}, {operacao}")
+            return f"⚠️ O bot está reiniciando. Seu registro ({passaporte}, {quantidade}x, {operacao}) foi salvo e será processado em breve."
+        except Exception as e:
+            logger.error(f"❌ Erro ao atualizar planilha: {str(e)}")
+            descartar_aba(aba_nome, e)
+            adiar_operacao(token)
+            if pendente:
+                raise
+            return f"⚠️ Problema ao atualizar a planilha. Seu registro ({passaporte}, {quantidade}x, {operacao}) foi salvo e será processado em breve."
+    finally:
+        concluir_operacao(token)
 
 # ======================== FUNÇÃO PARA RESET DOMINICAL ======================== #
 
@@ -387,10 +778,10 @@ def reset_domingo():
         # Reset das colunas 5 e 14 em cada aba usando atualizações em lote
         for aba_nome in abas_para_resetar:
             try:
-                aba = sheet.worksheet(aba_nome)
+                aba = obter_aba(aba_nome)
                 
                 # Obter todos os IDs (coluna 2)
-                ids = aba.col_values(2)
+                ids = update_with_exponential_backoff(lambda: aba.col_values(2))
                 
                 # Preparar atualizações em lote
                 batch_updates = []
@@ -412,18 +803,19 @@ def reset_domingo():
                 
                 # Aplicar todas as atualizações de uma vez
                 if batch_updates:
-                    aba.batch_update(batch_updates)
+                    update_with_exponential_backoff(lambda: aba.batch_update(batch_updates))
                 
                 logger.info(f"✅ Zerados os valores da aba {aba_nome}")
             except Exception as e:
                 logger.error(f"❌ Erro ao resetar aba {aba_nome}: {str(e)}")
+                descartar_aba(aba_nome, e)
         
         # Resetar coluna J (10) do painel de controle para -1000
         try:
-            painel = sheet.worksheet(PAINEL_CONTROLE)
+            painel = obter_aba(PAINEL_CONTROLE)
             
             # Obter todos os IDs (coluna 2)
-            ids = painel.col_values(2)
+            ids = update_with_exponential_backoff(lambda: painel.col_values(2))
             
             # Preparar atualizações em lote
             batch_updates = []
@@ -438,11 +830,12 @@ def reset_domingo():
             
             # Aplicar todas as atualizações de uma vez
             if batch_updates:
-                painel.batch_update(batch_updates)
+                update_with_exponential_backoff(lambda: painel.batch_update(batch_updates))
             
             logger.info("✅ Resetada a coluna J do painel de controle para -1000")
         except Exception as e:
             logger.error(f"❌ Erro ao resetar painel de controle: {str(e)}")
+            descartar_aba(PAINEL_CONTROLE, e)
         
         logger.info("✅ Reset dominical concluído com sucesso!")
         return True
@@ -450,6 +843,90 @@ def reset_domingo():
         logger.error(f"❌ Erro geral ao realizar reset dominical: {str(e)}")
         return False
 
+# ======================== RELATÓRIO SEMANAL ======================== #
+
+nomes_dias = ["Segunda", "Terça", "Quarta", "Quinta", "Sexta", "Sábado"]
+
+def _valor_inteiro(valor):
+    try:
+        return int(float(valor))
+    except (TypeError, ValueError):
+        return 0
+
+def _texto_celula(linha, indice):
+    if len(linha) <= indice:
+        return ""
+    valor = linha[indice]
+    if isinstance(valor, float) and valor.is_integer():
+        valor = int(valor)
+    return str(valor).strip()
+
+def _passaporte_da_linha(linha):
+    """Passaporte da coluna B (layout da planilha) ou, se B estiver vazia, da coluna A (linhas criadas pelo bot)"""
+    valor = _texto_celula(linha, 1) or _texto_celula(linha, 0)
+    return valor if valor.isdigit() else None
+
+def _intervalo(aba_nome, colunas):
+    """Intervalo em notação A1, escapando apóstrofos no nome da aba"""
+    return "'{}'!{}".format(aba_nome.replace("'", "''"), colunas)
+
+def buscar_dados_relatorio():
+    """Lê as abas FARM e o painel de controle em uma única leitura em lote e agrupa por passaporte"""
+    abas_farm = list(dict.fromkeys(dias[dia][0] for dia in range(len(nomes_dias))))
+    ranges = [_intervalo(aba_nome, "A2:N") for aba_nome in abas_farm] + [_intervalo(PAINEL_CONTROLE, "A2:J")]
+
+    resposta = update_with_exponential_backoff(
+        lambda: sheet.values_batch_get(ranges, params={"valueRenderOption": "UNFORMATTED_VALUE"})
+    )
+    value_ranges = resposta.get("valueRanges", [])
+
+    membros = {}
+
+    def membro(passaporte):
+        return membros.setdefault(passaporte, {"dias": [0] * len(nomes_dias), "meta": ""})
+
+    # Segunda a Sábado: colunas 5 (E) e 14 (N) de cada aba
+    for aba_nome, value_range in zip(abas_farm, value_ranges):
+        colunas = [(dia, dias[dia][1]) for dia in range(len(nomes_dias)) if dias[dia][0] == aba_nome]
+        for linha in value_range.get("values", []):
+            passaporte = _passaporte_da_linha(linha)
+            if not passaporte:
+                continue
+            registro = membro(passaporte)
+            for dia, coluna in colunas:
+                if len(linha) >= coluna:
+                    registro["dias"][dia] += _valor_inteiro(linha[coluna - 1])
+
+    # Meta semanal: coluna J (10) do painel de controle
+    if len(value_ranges) > len(abas_farm):
+        for linha in value_ranges[len(abas_farm)].get("values", []):
+            passaporte = _passaporte_da_linha(linha)
+            if passaporte and len(linha) >= 10:
+                membro(passaporte)["meta"] = linha[9]
+
+    logger.info(f"📊 Relatório semanal: {len(membros)} membros lidos de {len(ranges)} intervalos")
+    return membros
+
+def gerar_relatorio_csv(membros):
+    """Gera o relatório em CSV linha a linha"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def linha_csv(valores):
+        writer.writerow(valores)
+        conteudo = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+        return conteudo
+
+    yield linha_csv(["passaporte"] + nomes_dias + ["total", "meta_painel"])
+    for passaporte in sorted(membros, key=int):
+        registro = membros[passaporte]
+        yield linha_csv([passaporte] + registro["dias"] + [sum(registro["dias"]), registro["meta"]])
+
+def nome_arquivo_relatorio():
+    return f"relatorio_semanal_{get_brazil_datetime().strftime('%Y-%m-%d')}.csv"
+
 # ======================== EVENTOS DO DISCORD ======================== #
 
 # Configurar Intents do Discord
@@ -484,7 +961,6 @@ async def on_message(message):
     if message.author.bot:
         return  # Ignorar mensagens de outros bots
 
-
     logger.debug(f"📩 Mensagem recebida no canal {message.channel}: {message.content}")
 
     try:
@@ -499,6 +975,20 @@ async def on_message(message):
             else:
                 await message.channel.send("⚠️ O reset manual só pode ser realizado aos domingos.")
             return
+
+        # Relatório semanal
+        if message.content.lower().startswith("!relatorio") and message.author.guild_permissions.administrator:
+            try:
+                membros = buscar_dados_relatorio()
+            except Exception as e:
+                logger.error(f"❌ Erro ao gerar relatório: {str(e)}")
+                await message.channel.send("❌ **Erro ao gerar o relatório semanal.** Verifique os logs para mais detalhes.")
+                return
+
+            conteudo = "".join(gerar_relatorio_csv(membros)).encode("utf-8")
+            arquivo = discord.File(io.BytesIO(conteudo), filename=nome_arquivo_relatorio())
+            await message.channel.send(f"📊 **Relatório semanal** com {len(membros)} membros.", file=arquivo)
+            return
         
         # Comando de ajuda
         if message.content.lower() in ["!ajuda", "!help"]:
@@ -512,6 +1002,7 @@ async def on_message(message):
                 "- `Pass: 123 Retirou: 50x Al`\n\n"
                 "**Comandos administrativos:**\n"
                 "- `!reset` - Reseta os valores (apenas admins, apenas domingos)\n"
+                "- `!relatorio` - Gera o relatório semanal em CSV (apenas admins)\n"
                 "- `!ajuda` ou `!help` - Mostra esta mensagem\n\n"
                 "**Observações:**\n"
                 "- Registros aos domingos não são contabilizados\n"
@@ -555,9 +1046,39 @@ async def on_message(message):
 # ======================== GERENCIAMENTO DE ENCERRAMENTO GRACIOSO ======================== #
 
 def signal_handler(sig, frame):
-    logger.info("👋 Encerrando o bot...")
-    asyncio.run(discord_client.close())
-    logger.info("✅ Bot desconectado com sucesso.")
+    if encerrando.is_set():
+        logger.warning("⚠️ Encerramento já em andamento, aguardando...")
+        return
+
+    inicio = time.monotonic()
+    prazo = inicio + SHUTDOWN_TIMEOUT
+    logger.info(f"👋 Encerrando o bot (prazo de {SHUTDOWN_TIMEOUT:.1f}s)...")
+
+    # Parar de aceitar novas operações (sob o lock, para não concorrer com registrar_operacao)
+    with operacoes_lock:
+        encerrando.set()
+
+    # Aguardar as gravações em andamento, reservando parte do prazo para o Discord
+    drenar_operacoes(prazo - min(SHUTDOWN_CLOSE_RESERVE, SHUTDOWN_TIMEOUT / 2), prazo)
+
+    # Fechar a conexão com o Discord no próprio loop do cliente
+    if discord_loop is not None and discord_loop.is_running():
+        future = asyncio.run_coroutine_threadsafe(discord_client.close(), discord_loop)
+        try:
+            future.result(timeout=max(prazo - time.monotonic(), 0.5))
+            logger.info("✅ Bot desconectado com sucesso.")
+        except Exception as e:
+            logger.warning(f"⚠️ Não foi possível desconectar do Discord dentro do prazo: {type(e).__name__}")
+
+    # Relatório do encerramento
+    with operacoes_lock:
+        gravadas = list(operacoes_gravadas)
+        adiadas = list(operacoes_adiadas)
+    logger.info(f"📊 Encerramento concluído em {time.monotonic() - inicio:.1f}s: {len(gravadas)} operações gravadas, {len(adiadas)} adiadas")
+    for dados in gravadas:
+        logger.info(f"✅ Gravada: {dados['passaporte']}, {dados['quantidade']}, {dados['operacao']}")
+    for dados in adiadas:
+        logger.info(f"💾 Adiada para o arquivo de pendências: {dados['passaporte']}, {dados['quantidade']}, {dados['operacao']}")
     exit(0)
 
 signal.signal(signal.SIGINT, signal_handler)
@@ -566,7 +1087,7 @@ signal.signal(signal.SIGTERM, signal_handler)
 # ======================== FUNÇÕES DE VERIFICAÇÃO PERIÓDICA ======================== #
 
 async def periodic_tasks():
-    while True:
+    while not encerrando.is_set():
         try:
             # Verificar se é domingo e se já é hora de reset (12h)
             brazil_now = get_brazil_datetime()
@@ -597,10 +1118,12 @@ async def periodic_tasks():
 # ======================== INICIAR O BOT E O FLASK EM PARALELO ======================== #
 
 def run_discord_bot():
+    global discord_loop
     try:
         logger.info("🚀 Configurando loop do Discord...")
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
+        discord_loop = loop  # Usado pelo encerramento para fechar o cliente neste loop
         
         # Validar o token do Discord
         if not DISCORD_TOKEN:
@@ -671,6 +1194,11 @@ if __name__ == "__main__":
         logger.error(f"❌ Erro ao conectar com Google Sheets: {str(e)}")
         logger.info("⚠️ O bot continuará tentando reconectar periodicamente")
     
+    # Renovar o token de acesso do Google em segundo plano
+    token_thread = Thread(target=renovar_token_periodicamente)
+    token_thread.daemon = True
+    token_thread.start()
+    
     # Rodar o bot do Discord em uma thread separada
     logger.info("🔄 Iniciando bot Discord...")
     discord_thread = Thread(target=run_discord_bot)